@@ -36,6 +36,13 @@ import math, subprocess
 from enum import IntEnum
 from pathlib import Path
 import shutil
+import functools
+import operator
+import os, sys, tempfile
+import threading
+import queue
+import re
+import time
 
 import bpy
 from bpy.types import PropertyGroup, AddonPreferences
@@ -53,63 +60,96 @@ class ShapeType(IntEnum):
     POINTER = 5
     DONTDRAW = 6
 
+# id frame vals_01 type scale(3) position(3) rotation vals_02 filepath vals_03 script
+_SHAPE_LINE_TEMPLATE = "%d %d %s %d %g %g %g %g %g %g %g %s %s %s %s \n"
+# the vals blocks always have these widths in shapetable.dat
+_V01 = " ".join(["%d"] * 12)
+_V02 = " ".join(["%d"] * 6)
+_V03 = " ".join(["%d"] * 4)
+
 class ShapeEntry:
     """Represents an entry in the shape table"""
 
+    __slots__ = ("id", "frame", "is_shape_ref", "type", "scale", "position", "rotation",
+                 "filepath", "script", "vals_01", "vals_02", "vals_03", "original_line", "_vals_text")
+
     def __init__(self, *args, **kwargs ):
         self.id = 0
         self.frame = 0
         self.is_shape_ref = False
         self.type = ShapeType.MESH
-        self.scale = Vector((1,1,1))
-        self.position = Vector((0,0,0))
+        self.scale = (1.0, 1.0, 1.0)
+        self.position = (0.0, 0.0, 0.0)
         self.rotation = 0
         self.filepath = ""
         self.script="Default"
+        self.vals_01 = (0,) * 12
+        self.vals_02 = (0,) * 6
+        self.vals_03 = (0,) * 4
+        self.original_line = ""
+        # joined vals_01/02/03 as read from the file, None whenever they have to be rebuilt
+        self._vals_text = None
 
     def __str__(self):
         return f"<ShapeEntry {self.id:3d} Frame {self.frame:2d} Type {self.type.name}>"
 
     def to_line(self) -> str:
-        line = f"{self.id} "
-        line += f"{self.frame} "
-        line += " ".join([f"{v}" for v in self.vals_01])
-        line += f" {self.type} "
-        line += f"{self.scale.x:g} {self.scale.y:g} {self.scale.z:g} "
-        line += f"{self.position.x:g} {self.position.y:g} {self.position.z:g} "
-        line += f"{self.rotation:g} "
-        line += " ".join([f"{v}" for v in self.vals_02])
-        line += f" {self.filepath} "
-        line += " ".join([f"{v}" for v in self.vals_03])
-        line += f" {self.script}"
-        line += " \n"
-        return line
+        if self._vals_text is None:
+            self._vals_text = (_V01 % self.vals_01, _V02 % self.vals_02, _V03 % self.vals_03)
+        vals_01, vals_02, vals_03 = self._vals_text
+        return _SHAPE_LINE_TEMPLATE % (
+            self.id, self.frame,
+            vals_01,
+            int(self.type),
+            *self.scale,
+            *self.position,
+            self.rotation,
+            vals_02,
+            self.filepath,
+            vals_03,
+            self.script)
+
+    def apply_settings(self, sh):
+        """Takes over the exported values from the object settings."""
+        self.type = int(sh.shape_type)
+        self.scale = tuple(sh.scale)
+        self.position = tuple(sh.position)
+        self.rotation = sh.rotation
+        self.filepath = sh.mesh_path()
+
+    @classmethod
+    def _bare(cls):
+        """Creates an entry without running __init__, for callers that set every field themselves."""
+        return cls.__new__(cls)
 
     @staticmethod
     def from_line(line: str) -> None:
-        se = ShapeEntry()
-        values = line.strip().split(" ")
+        return ShapeEntry.from_tokens(line.split(), line)
+
+    @staticmethod
+    def from_tokens(values, line: str):
+        """Builds an entry from an already split line. The line is only kept for non-mesh shapes."""
+        se = ShapeEntry._bare()
+        se.is_shape_ref = False
         se.id = int(values[0])
         se.frame = int(values[1])
-        se.vals_01 = [int(v) for v in values[2:14]] # Todo: Find out, what these vals are
+        se.vals_01 = tuple(map(int, values[2:14])) # Todo: Find out, what these vals are
 
         se.type = ShapeType(int(values[14]))
         if se.type != ShapeType.MESH:
             se.original_line = line
         else:
             se.original_line = ""
-        se.scale = Vector( (float(values[15]),float(values[16]), float(values[17]) ) )
-        se.position = Vector( (float(values[18]),float(values[19]), float(values[20]) ) )
+        se.scale = tuple(map(float, values[15:18]))
+        se.position = tuple(map(float, values[18:21]))
         se.rotation = float(values[21])
         
-        se.vals_02 = [int(v) for v in values[22:28]] # Todo: Find out, what these vals are
-        se.filepath = values[28]
-        se.vals_03 = [int(v) for v in values[29:33]] # Todo: Find out, what these vals are
-        try:
-            se.script = values[33]
-        except Exception as e:
-            # print(f"WARNING: No script found for shape {values[0]}!")
-            se.script = "default"
+        se.vals_02 = tuple(map(int, values[22:28])) # Todo: Find out, what these vals are
+        se.filepath = sys.intern(values[28])
+        se.vals_03 = tuple(map(int, values[29:33])) # Todo: Find out, what these vals are
+        se._vals_text = (sys.intern(" ".join(values[2:14])), sys.intern(" ".join(values[22:28])), sys.intern(" ".join(values[29:33])))
+        # older rows have no script column
+        se.script = sys.intern(values[33]) if len(values) > 33 else "default"
 
         # if se.id==252 and se.frame==0:
         #     print(f"Shape {se.id}-{se.frame} Sca: {values[15:18]} {se.scale}")
@@ -122,6 +162,8 @@ class ShapeEntry:
 class ShapeTable:
     """Reads and writes the shape table. Now a singleton."""
     _instance = None
+    # exports write the table from a worker thread
+    _lock = threading.RLock()
 
     def __init__(self):
         raise RuntimeError('Call instance() instead')
@@ -131,84 +173,231 @@ class ShapeTable:
         if cls._instance is None:
             print('Creating new instance')
             cls._instance = cls.__new__(cls)
+            cls.rows = []
             cls.shapes = dict()
             cls.is_loaded = False
+            cls.mtime = None
         return cls._instance
 
     def load(self, filepath, force=False):
+        with self._lock:
+            self._load(filepath, force)
+
+    def _load(self, filepath, force):
         # print(f"ShapeTable: is_loaded: {self.is_loaded}, force: {force} => {self.is_loaded and not force}")
-        if self.is_loaded and not force:
+        mtime = os.stat(filepath).st_mtime_ns
+        if self.is_loaded and not force and mtime == self.mtime:
             print(f"U7R-ShapeTable: Using cached ShapeTable data.")
             return
         wm = bpy.context.window_manager
         wm.progress_begin(0, 100)
+        self.rows = []
         self.shapes = dict()
         wm.progress_update(66)
         with open(filepath) as shapefile:
-            for line in shapefile.readlines():
-                shape_obj = ShapeEntry.from_line(line)
-                if not shape_obj.id in self.shapes:
-                    self.shapes[shape_obj.id] = []
-                self.shapes[shape_obj.id].append(shape_obj)
+            for line in shapefile:
+                key = line.split(None, 2)[:2]
+                if not key:
+                    continue
+                # rows keep the raw line until entry() parses it, shapes maps (shape id, frame) to the row
+                self.shapes.setdefault((int(key[0]), int(key[1])), len(self.rows))
+                self.rows.append(line)
         self.is_loaded = True
+        self.mtime = mtime
         print("U7R-ShapeTable: All shapes loaded.")
         wm.progress_end()
 
     def save(self, filepath):
-        lines=[]
-        for so_id, frames in self.shapes.items():
-            for frame in frames:
-                lines.append(frame.to_line())
-
-        with open(filepath, "w") as shapefile:
-            shapefile.writelines(lines)
+        with self._lock:
+            # serialize before opening, so a bad entry can't leave a truncated file behind
+            # rows that were never parsed are written back exactly as they were read
+            buffer = "".join(row if isinstance(row, str) else row.to_line() for row in self.rows)
+            with open(filepath, "w") as shapefile:
+                shapefile.write(buffer)
+            self.mtime = os.stat(filepath).st_mtime_ns
+
+    def entry(self, shape_id, frame):
+        pos = self.shapes[(shape_id, frame)]
+        row = self.rows[pos]
+        if isinstance(row, str):
+            row = ShapeEntry.from_line(row)
+            self.rows[pos] = row
+        return row
+
+    def frames_of(self, shape_id):
+        """All entries of a shape, ordered by frame."""
+        return [self.entry(*key) for key in sorted(key for key in self.shapes if key[0] == shape_id)]
 
     def restore_shape(self, shape_id, frame):
-        if self.shapes[shape_id][frame].original_line:
-            print(f"Original Line: {self.shapes[shape_id][frame].original_line}")
-        # self.shapes[sh.shape_id][sh.frame] = ShapeEntry.from_line()
+        if self.entry(shape_id, frame).original_line:
+            print(f"Original Line: {self.entry(shape_id, frame).original_line}")
+        # self.shapes[(sh.shape_id, sh.frame)] = ShapeEntry.from_line()
 
     def update_shapes(self, *shape_settings):
-        for sh in shape_settings:
-            if sh.shape_id not in self.shapes:
-                print(f"Shape {sh.shape_id} not found in shapetable.dat")
-                continue
-            # print(f"{sh.shape_id}-{sh.frame}: {sh.shape_type} {sh.scale} {sh.mesh_path()}")
-            # print(f"B {self.shapes[sh.shape_id][sh.frame].to_line()}")
-            self.shapes[sh.shape_id][sh.frame].type = int(sh.shape_type)
-            self.shapes[sh.shape_id][sh.frame].scale = sh.scale
-            self.shapes[sh.shape_id][sh.frame].position = sh.position
-            self.shapes[sh.shape_id][sh.frame].rotation = sh.rotation
-            # print(f"A  {self.shapes[sh.shape_id][sh.frame].to_line()}")
-            self.shapes[sh.shape_id][sh.frame].filepath = sh.mesh_path()
+        with self._lock:
+            for sh in shape_settings:
+                if (sh.shape_id, sh.frame) not in self.shapes:
+                    print(f"Shape {sh.shape_id} not found in shapetable.dat")
+                    continue
+                entry = self.entry(sh.shape_id, sh.frame)
+                # print(f"{sh.shape_id}-{sh.frame}: {sh.shape_type} {sh.scale} {sh.mesh_path()}")
+                # print(f"B {self.entry(sh.shape_id, sh.frame).to_line()}")
+                entry.apply_settings(sh)
+                # print(f"A  {self.entry(sh.shape_id, sh.frame).to_line()}")
+
+    def update_file(self, filepath, *shape_settings):
+        """Rewrites only the lines of the given shapes in the file, everything else is copied through."""
+        with self._lock:
+            self._update_file(Path(filepath), shape_settings)
+
+    def _update_file(self, filepath, shape_settings):
+        in_sync = self.is_loaded and os.stat(filepath).st_mtime_ns == self.mtime
+        pending = {(str(sh.shape_id), str(sh.frame)): sh for sh in shape_settings}
+        dst = None
+        try:
+            with open(filepath) as src, tempfile.NamedTemporaryFile("w", dir=filepath.parent, delete=False) as dst:
+                for line in src:
+                    sh = pending.pop(tuple(line.split(None, 2)[:2]), None) if pending else None
+                    if sh is None:
+                        dst.write(line)
+                        continue
+                    shape_obj = ShapeEntry.from_line(line)
+                    shape_obj.apply_settings(sh)
+                    dst.write(shape_obj.to_line())
+            shutil.copymode(filepath, dst.name)
+            os.replace(dst.name, filepath)
+        except BaseException:
+            # both files are closed here, so the half written temp file can go
+            if dst is not None:
+                os.unlink(dst.name)
+            raise
+        for sh in pending.values():
+            print(f"Shape {sh.shape_id} not found in shapetable.dat")
+        # keep the cached table in sync with the file, unless it was already outdated
+        if in_sync:
+            # the missing shapes were reported above already
+            self.update_shapes(*(sh for sh in shape_settings if (str(sh.shape_id), str(sh.frame)) not in pending))
+            self.mtime = os.stat(filepath).st_mtime_ns
+        else:
+            self.is_loaded = False
+
+class ShapeSettingsSnapshot:
+    """Plain copy of an object's export settings, safe to hand to a worker thread."""
+
+    __slots__ = ("shape_id", "frame", "shape_type", "scale", "position", "rotation", "_mesh_path")
+
+    def __init__(self, settings, base_gamepath=None):
+        self.shape_id = settings.shape_id
+        self.frame = settings.frame
+        self.shape_type = settings.shape_type
+        self.scale = tuple(settings.scale)
+        self.position = tuple(settings.position)
+        self.rotation = settings.rotation
+        self._mesh_path = settings.mesh_path(base_gamepath)
+
+    def mesh_path(self):
+        return self._mesh_path
 
 # --------------------------------------------------------------------------------
 # Utilities
 # --------------------------------------------------------------------------------
 
+_GAME_PATH_CACHE = {}
+
+def _game_path():
+    """ Returns the game path from the addon prefs as a Path. """
+    game_path = bpy.context.preferences.addons["ultimavii_exporter"].preferences.game_path
+    path = _GAME_PATH_CACHE.get(game_path)
+    if path is None:
+        path = Path(game_path)
+        _GAME_PATH_CACHE[game_path] = path
+    return path
+
+@functools.lru_cache(maxsize=8)
+def _game_exe(game_path):
+    """ Returns the path of the game executable. """
+    return game_path / "U7Revisited.exe"
+
+@functools.lru_cache(maxsize=8)
+def _models_dir(game_path):
+    """ Returns the Models/3dmodels folder of the game. """
+    return game_path / "Models" / "3dmodels"
+
+_EXISTS_TTL = 2.0
+_EXISTS_CACHE = {}
+
+def _cached_exists(path):
+    now = time.monotonic()
+    cached = _EXISTS_CACHE.get(path)
+    if cached is not None and now - cached[0] < _EXISTS_TTL:
+        return cached[1]
+    exists = path.exists()
+    _EXISTS_CACHE[path] = (now, exists)
+    return exists
+
+@functools.lru_cache(maxsize=128)
+def _relative_posix_path(filepath, base_path):
+    return Path(filepath).relative_to(base_path).as_posix()
+
 def select(*objs):
-    bpy.ops.object.select_all(action='DESELECT')
+    for obj in bpy.context.selected_objects:
+        obj.select_set(False)
     bpy.context.view_layer.objects.active = objs[0]
     for obj in objs:
         print(f"Selecting {obj.name}")
         obj.select_set(True)
 
+def restore_selection(context, objs, active):
+    """ Reselects the given objects and active object. """
+    for obj in context.selected_objects:
+        obj.select_set(False)
+    for obj in objs:
+        obj.select_set(True)
+    context.view_layer.objects.active = active
+
+def shape_refs_by_parent(roots):
+    """ Maps parent names to the settings of their shape reference children, over the hierarchies of the given roots. """
+    refs = {}
+    seen = set()
+    for root in roots:
+        for o in root.children_recursive:
+            if o.parent is None or o.name in seen:
+                continue
+            seen.add(o.name)
+            settings = o.uvii_export_settings
+            if settings.is_uvii and settings.is_shape_ref:
+                refs.setdefault(o.parent.name, []).append(settings)
+    return refs
+
+def _shape_ref_settings(obj, shape_refs=None):
+    if shape_refs is not None:
+        return shape_refs.get(obj.name, ())
+    return [o.uvii_export_settings for o in obj.children if o.uvii_export_settings.is_uvii and o.uvii_export_settings.is_shape_ref]
+
+def _iter_uvii(objects):
+    """ Yields (object, settings) for the exportable objects. """
+    for obj in objects:
+        settings = obj.uvii_export_settings
+        if settings.is_uvii:
+            yield obj, settings
+
 def get_hierarchy(*objs):
-    newobjs=[]    
-    testobjs=list(objs)
-    while testobjs:
-        obj=testobjs.pop()
-        testobjs.extend(obj.children)
-        newobjs.append(obj)
+    newobjs=list(objs)
+    for obj in objs:
+        newobjs.extend(obj.children_recursive)
     return newobjs
 
+@functools.lru_cache(maxsize=256)
+def _model_filename(name, shape_id, frame, add_suffix):
+    modelname = f"{name.lower().split('.')[0]}"
+    suffix = f"_{shape_id:004d}x{frame:002d}" if add_suffix else ""
+    return f"{modelname}{suffix}"
+
 def model_to_filename(obj):
     """ Generates a standardized obj name """
     # <object name>_<shape number>x<frame number>
     settings = obj.uvii_export_settings
-    modelname = f"{obj.name.lower().split('.')[0]}"
-    suffix = f"_{settings.shape_id:004d}x{settings.frame:002d}" if settings.add_shape_frame_suffix else ""
-    return f"{modelname}{suffix}"
+    return _model_filename(obj.name, settings.shape_id, settings.frame, settings.add_shape_frame_suffix)
 
 # def parent_to_filename(obj):
 #     """ Generates a standardized obj name """
@@ -216,52 +405,72 @@ def model_to_filename(obj):
 #     pobj = obj.parent
 #     return f"{pobj.name.lower()}_{pobj.uvii_export_settings.shape_id:004d}x{pobj.uvii_export_settings.frame:002d}"
 
-def full_export_filepath(obj):
-    addon_prefs = bpy.context.preferences.addons["ultimavii_exporter"].preferences
+@functools.lru_cache(maxsize=256)
+def _export_filepath(models_dir, filename):
+    return models_dir / filename
+
+def full_export_filepath(obj, base_gamepath=None):
     # return Path(addon_prefs.game_path) / "Models" / "3dmodels" / (parent_to_filename(obj)+obj.uvii_export_settings.format_suffix())
     # else:
-    return Path(addon_prefs.game_path) / "Models" / "3dmodels" / (model_to_filename(obj)+obj.uvii_export_settings.format_suffix())
+    if base_gamepath is None:
+        base_gamepath = _game_path()
+    return _export_filepath(_models_dir(base_gamepath), model_to_filename(obj)+obj.uvii_export_settings.format_suffix())
 
 def add_to_modelnames(objname):
     """Writes the model name into the modelnames.txt file"""
-    addon_prefs = bpy.context.preferences.addons["ultimavii_exporter"].preferences
-    modelnames_filepath = Path(addon_prefs.game_path) / "Models" / "3dmodels" / "modelnames.txt"
+    modelnames_filepath = _models_dir(_game_path()) / "modelnames.txt"
     if not modelnames_filepath.exists():
         print(f"Could not find {modelnames_filepath}")
         return
 
-    with open(modelnames_filepath) as modelfile:
-        lines = [l.strip() for l in modelfile.readlines()]
+    with open(modelnames_filepath, "r+") as modelfile:
+        text = modelfile.read()
+        if objname in {l.strip() for l in text.splitlines()}:
+            return
+        if text and not text.endswith("\n"):
+            modelfile.write("\n")
+        modelfile.write(f"{objname}\n")
 
-    if not objname in lines:
-        lines.append(objname)
 
-    with open(modelnames_filepath, "w") as modelfile:
-        modelfile.writelines( [f"{l}\n" for l in lines] )
+# material pointer -> texture path, cleared whenever a material or image changes
+_TEX_PATH_CACHE = {}
 
+@bpy.app.handlers.persistent
+def clear_tex_path_cache(scene, depsgraph):
+    if not _TEX_PATH_CACHE:
+        return
+    for update in depsgraph.updates:
+        if isinstance(update.id, (bpy.types.Material, bpy.types.Image)):
+            _TEX_PATH_CACHE.clear()
+            return
 
 def get_color_tex_path(mat):
     """ Returns an absolute path object of the base color if exists. """
+    cached = _TEX_PATH_CACHE.get(mat.as_pointer())
+    if cached is not None and cached.exists():
+        return cached
+    if not mat.use_nodes or mat.node_tree is None or not mat.node_tree.nodes:
+        print(f"Material '{mat.name}' doesn't use nodes.")
+        return None
     shader_node = None
-    for n in mat.node_tree.nodes:
-        if n.type == "BSDF_PRINCIPLED":
-            shader_node = n
-            break
+    output_node = mat.node_tree.get_output_node('ALL')
+    if output_node is not None and output_node.inputs["Surface"].links:
+        shader_node = output_node.inputs["Surface"].links[0].from_node
+    if shader_node is None or shader_node.type != "BSDF_PRINCIPLED":
+        shader_node = mat.node_tree.nodes.get("Principled BSDF")
+    if shader_node is None or shader_node.type != "BSDF_PRINCIPLED":
+        shader_node = next((n for n in mat.node_tree.nodes if n.type == "BSDF_PRINCIPLED"), None)
     if shader_node == None:
-        print("No Shader Node found in material '{mat.name}''.")
+        print(f"No Shader Node found in material '{mat.name}'.")
         return None
-    base_color_input = None
-    for i in n.inputs:
-        if i.name == "Base Color":
-            base_color_input = i
-            break
+    base_color_input = shader_node.inputs.get("Base Color")
     if base_color_input==None:
-        print("No base color input found in material '{mat.name}''.")
+        print(f"No base color input found in material '{mat.name}'.")
         return None
-    src_node = base_color_input.links[0].from_node
-    if src_node==None:
-        print("No base color node connected to material '{mat.name}''.")
+    if not base_color_input.links:
+        print(f"No base color node connected to material '{mat.name}'.")
         return None
+    src_node = base_color_input.links[0].from_node
     if src_node.type!="TEX_IMAGE":
         print("Base color node is not an image texture.")
         return None
@@ -272,36 +481,122 @@ def get_color_tex_path(mat):
     if not tex_path.exists():
         print(f"Image file '{tex_path}' doesn't exist.")
         return None
+    _TEX_PATH_CACHE[mat.as_pointer()] = tex_path
     return tex_path
 
+def _copy_if_newer(src, dst):
+    """ Copies src to dst, unless dst already has the same size and is at least as new. """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        pass
+    else:
+        src_stat = os.stat(src)
+        if dst_stat.st_size == src_stat.st_size and dst_stat.st_mtime_ns >= src_stat.st_mtime_ns:
+            return False
+    shutil.copyfile(src, dst)
+    return True
+
+# already compressed formats
+_STORED_SUFFIXES = frozenset((".png", ".jpg", ".jpeg", ".dds", ".ktx2", ".webp"))
+
+_ZIP_STREAM_THRESHOLD = 256 * 1024
+_ZIP_COPY_BUFFER = 1024 * 1024
+
+_MAP_KD_RE = re.compile(r"^map_Kd.*$", re.MULTILINE)
+
 def replace_mdl_texture_entry(mtl_path, tex_path):
-    lines = []
+    mtl_path = Path(mtl_path)
+    tex_entry = f"map_Kd {tex_path.as_posix()}"
     with open(mtl_path) as mat_file:
-        for line in mat_file.readlines():
-            if line.startswith("map_Kd"):
-                lines.append(f"map_Kd {tex_path.as_posix()}\n")
-            else:
-                lines.append(line)
-
-    with open(mtl_path, "w") as mat_file:
-        # mat_file.writelines( [f"{l} \n" for l in lines] )    
-        mat_file.writelines( lines )
+        text = _MAP_KD_RE.sub(lambda m: tex_entry, mat_file.read())
+    new_file = tempfile.NamedTemporaryFile("w", dir=mtl_path.parent, delete=False)
+    try:
+        with new_file:
+            new_file.write(text)
+        shutil.copymode(mtl_path, new_file.name)
+        os.replace(new_file.name, mtl_path)
+    except BaseException:
+        os.unlink(new_file.name)
+        raise
 
 # --------------------------------------------------------------------------------
 # Export Functionality
 # --------------------------------------------------------------------------------
 
-def export_object_to_OBJ(obj, context):
+# finished export reports, filled by the worker thread and shown by a timer on the main thread
+_POST_EXPORT_RESULTS = queue.Queue()
+_post_export_thread = None
+
+def run_post_export_io(report, io_groups):
+    """ Runs the queued file writes of an export on the worker thread. Must not touch bpy, the report goes into the queue. """
+    failed = False
+    for obj_name, io_tasks in io_groups:
+        for description, func, *args in io_tasks:
+            try:
+                result = func(*args)
+            except Exception as e:
+                # the remaining writes of this object depend on the failed one
+                report.append(f"Writing the export files for {obj_name} failed: {e}")
+                failed = True
+                break
+            if description and result is not False:
+                report.append(description)
+    print("Finished writing export files")
+    _POST_EXPORT_RESULTS.put((report, failed))
+
+def show_post_export_reports():
+    """ Timer callback, bpy is only safe to use on the main thread. """
+    while True:
+        try:
+            report, failed = _POST_EXPORT_RESULTS.get_nowait()
+        except queue.Empty:
+            break
+        bpy.context.window_manager.popup_menu(
+            lambda self, ctx: ( [self.layout.label(text=x) for x in report] ),
+            title="Export Report",
+            icon='ERROR' if failed else 'INFO')
+    if _post_export_thread is not None and _post_export_thread.is_alive():
+        return 0.1
+    # the worker may have queued its report right after the queue was drained
+    if not _POST_EXPORT_RESULTS.empty():
+        return 0.0
+    return None
+
+def wait_for_post_export_io():
+    """ Blocks until the file writes of the previous export are done. """
+    if _post_export_thread is not None:
+        _post_export_thread.join()
+
+def start_post_export_io(report, io_groups):
+    """ Runs the file writes of an export on a worker thread, then shows the report.
+    Operators touching the exported files call wait_for_post_export_io() first. """
+    global _post_export_thread
+    _post_export_thread = threading.Thread(target=run_post_export_io, args=(report, io_groups))
+    _post_export_thread.start()
+    if not bpy.app.timers.is_registered(show_post_export_reports):
+        bpy.app.timers.register(show_post_export_reports, first_interval=0.1, persistent=True)
+
+def shapetable_report(shape_snapshots):
+    return "Updated Shapes in shapetable.dat: "+", ".join(f"S{e.shape_id:04d}F{e.frame:02d}" for e in shape_snapshots)
+
+def export_object_to_OBJ(obj, context, io_groups, shape_snapshots=None, base_gamepath=None, shape_refs=None):
+    """ Exports one asset. The file writes after the mesh export are queued into io_groups as (description, func, *args) tasks.
+    If shape_snapshots is given, the shapetable rows are collected there instead of being written. """
     addon_prefs = context.preferences.addons["ultimavii_exporter"].preferences
-    base_gamepath = Path(addon_prefs.game_path)
+    if base_gamepath is None:
+        base_gamepath = _game_path()
+    shapetable_path = base_gamepath / "data" / "shapetable.dat"
     # obj = context.active_object
     # need to make sure active object is selected, otherwise exporting empty file!
     obj.select_set(True)        
     settings = obj.uvii_export_settings
-    export_path = full_export_filepath(obj)
-    settings.export_path = str(export_path)
+    export_path = full_export_filepath(obj, base_gamepath)
+    export_path_str = str(export_path)
+    mtl_path = export_path.with_suffix(".mtl")
+    settings.export_path = export_path_str
 
-    print(f"Exporting {obj.name} to {str(export_path)}")
+    print(f"Exporting {obj.name} to {export_path_str}")
 
     if addon_prefs.reset_matrix:
         orig_matrix = obj.matrix_world.copy()
@@ -310,7 +605,7 @@ def export_object_to_OBJ(obj, context):
     # export shape mesh
     select(obj)
     bpy.ops.wm.obj_export(
-        filepath=settings.export_path, 
+        filepath=export_path_str, 
         check_existing=False, 
         apply_modifiers=True, 
         export_selected_objects=True,
@@ -322,11 +617,12 @@ def export_object_to_OBJ(obj, context):
     if addon_prefs.reset_matrix:
         obj.matrix_world = orig_matrix
 
-    output_message = [f"Successfully exported '{full_export_filepath(obj).name}'"]
+    output_message = [f"Successfully exported '{export_path.name}'"]
+    # the file writes after the mesh export run on a worker thread, so everything they need is collected here
+    io_tasks = []
 
     # fix shape mesh texture path
     if settings.export_format == "OBJ" and len(obj.data.materials)>0:
-        mtl_path = Path(settings.export_path).with_suffix(".mtl")            
         tex_path = get_color_tex_path(obj.data.materials[0])
         if not mtl_path.exists():
             bpy.context.window_manager.popup_menu(
@@ -344,10 +640,9 @@ def export_object_to_OBJ(obj, context):
             if export_path.parent!=tex_path.parent:
                 if addon_prefs.copy_texture:
                     new_tex_path = export_path.with_name(tex_path.name)
-                    output_message.append(f"Copied texture {tex_path.name} to {new_tex_path}")
-                    shutil.copy(tex_path, new_tex_path)
+                    io_tasks.append((f"Copied texture {tex_path.name} to {new_tex_path}", _copy_if_newer, tex_path, new_tex_path))
                     tex_path=new_tex_path
-                replace_mdl_texture_entry(mtl_path, tex_path.relative_to(base_gamepath))
+                io_tasks.append((None, replace_mdl_texture_entry, mtl_path, tex_path.relative_to(base_gamepath)))
             else:
                 bpy.context.window_manager.popup_menu(
                     lambda self, ctx: ( [self.layout.label(text=x) for x in ["Texture is not located in the model directory!", "It will not show up!"]] ),
@@ -359,17 +654,18 @@ def export_object_to_OBJ(obj, context):
         # collect entries
         entries = []
         entries.append(settings)
-        for o in obj.children:
-            if o.uvii_export_settings.is_uvii and o.uvii_export_settings.is_shape_ref:
-                o.uvii_export_settings.export_path = str(export_path)
-                entries.append(o.uvii_export_settings)
+        for child_settings in _shape_ref_settings(obj, shape_refs):
+            child_settings.export_path = export_path_str
+            entries.append(child_settings)
         # update shapetable
-        shapetable = ShapeTable.instance()
-        shapetable.load(base_gamepath / "data" / "shapetable.dat")
-        shapetable.update_shapes(*entries)
-        shapetable.save(base_gamepath / "data" / "shapetable.dat")
+        snapshots = [ShapeSettingsSnapshot(e, base_gamepath) for e in entries]
+        if shape_snapshots is None:
+            io_tasks.append((shapetable_report(snapshots), ShapeTable.instance().update_file, shapetable_path, *snapshots))
+        else:
+            shape_snapshots.extend(snapshots)
 
-        output_message.append("Updated Shapes in shapetable.dat: "+", ".join([f"S{e.shape_id:04d}F{e.frame:02d}" for e in entries]))
+    if io_tasks:
+        io_groups.append((obj.name, io_tasks))
 
     return output_message
 
@@ -382,6 +678,11 @@ def export_object_to_OBJ(obj, context):
 # Addon Prefs
 # --------------------------------------------------------------------------------
 
+def game_path_changed(self, context):
+    # the cached shapetable and existence checks belong to the old game folder
+    ShapeTable.instance().is_loaded = False
+    _EXISTS_CACHE.clear()
+
 class SCRIPTS_AP_uvii_settings(AddonPreferences):
     # this must match the add-on name, use '__package__'
     # when defining this in a submodule of a python package.
@@ -392,7 +693,8 @@ class SCRIPTS_AP_uvii_settings(AddonPreferences):
         description="Ultima VII Revisited Game Path",
         subtype="DIR_PATH",
         default="",
-        maxlen=0
+        maxlen=0,
+        update=game_path_changed
     )
 
     write_shapetable: bpy.props.BoolProperty(
@@ -425,9 +727,16 @@ class SCRIPTS_AP_uvii_settings(AddonPreferences):
         description="What will be applied as a default to every new shape."
     )
 
+    debug_output: bpy.props.BoolProperty(
+        name="Debug output",
+        default=False,
+        description="Prints the settings of every packed shape to the console."
+    )
+
     def draw(self, context):
         self.layout.prop(self, "add_shape_frame_suffix_default")
         self.layout.prop(self, "game_path")
+        self.layout.prop(self, "debug_output")
 
 # --------------------------------------------------------------------------------
 # Object Settings
@@ -542,21 +851,16 @@ class SCRIPTS_PG_uvii_object_settings(PropertyGroup):
         maxlen=0
     )
 
+    _SUFFIX_MAP = {"OBJ": ".obj", "GLTF": ".gltf"}
+
     def format_suffix(self):
-        if self.export_format == "OBJ":
-            return ".obj"
-        elif self.export_format == "GLTF":
-            return ".gltf"
-        else:
-            return ""
+        return self._SUFFIX_MAP.get(self.export_format, "")
 
     def mesh_name(self):
         return Path(self.export_path).stem
 
-    def mesh_path(self):
-        addon_prefs = bpy.context.preferences.addons["ultimavii_exporter"].preferences
-        base_gamepath = Path(addon_prefs.game_path)
-        return Path(self.export_path).relative_to(base_gamepath).as_posix()
+    def mesh_path(self, base_gamepath=None):
+        return _relative_posix_path(self.export_path, base_gamepath or _game_path())
 
     # def shape(self):
     #     shape = ShapeEntry()
@@ -648,8 +952,8 @@ class SCRIPTS_OT_uvii_reload_shapedata(bpy.types.Operator):
     bl_label = "Reload shapedata"
 
     def execute(self, context):
-        addon_prefs = context.preferences.addons["ultimavii_exporter"].preferences
-        base_gamepath = Path(addon_prefs.game_path)
+        wait_for_post_export_io()
+        base_gamepath = _game_path()
         shapetable = ShapeTable.instance()
         shapetable.load(base_gamepath / "data" / "shapetable.dat", force=True)
         return {'FINISHED'}
@@ -683,7 +987,7 @@ class SCRIPTS_OT_uvii_select_filepath(bpy.types.Operator):
         if settings.export_path!="":
             self.filepath = settings.export_path
         else:
-            model_path = Path(addon_prefs.game_path) / "Models" / "3dmodels" / (context.active_object.name+settings.format_suffix())
+            model_path = _models_dir(_game_path()) / (context.active_object.name+settings.format_suffix())
             self.filepath = str(model_path)
         if settings.export_format == "OBJ":
             self.filter_glob = "*.obj"
@@ -708,23 +1012,38 @@ class SCRIPTS_OT_uvii_export_asset(bpy.types.Operator):
         return context.active_object is not None
 
     def execute(self, context):
-        original_selection = [o for o in context.selected_objects]
+        # the previous export may still be writing the same files
+        wait_for_post_export_io()
+        original_selection = context.selected_objects
+        original_active = context.view_layer.objects.active
         output_messages = []
+        # file writes that run on the worker thread once all meshes are exported
+        io_groups = []
+        base_gamepath = _game_path()
         if len(context.selected_objects)==0:
-            output_messages += export_object_to_OBJ(context.active_object, context)
+            output_messages += export_object_to_OBJ(context.active_object, context, io_groups, base_gamepath=base_gamepath)
         else:
+            # the progress bar only counts the objects that actually get exported
+            uvii_objects = list(_iter_uvii(original_selection))
             wm = bpy.context.window_manager
-            wm.progress_begin(0, len(context.selected_objects))
+            wm.progress_begin(0, len(uvii_objects))
             i=1
-            for obj in context.selected_objects:
+            shape_snapshots = []
+            shape_refs = shape_refs_by_parent(obj for obj, _ in uvii_objects)
+            for obj, _ in uvii_objects:
                 wm.progress_update(i)
                 i+=1
-                if not obj.uvii_export_settings.is_uvii:
-                    continue
-                output_messages += export_object_to_OBJ(obj, context)
+                output_messages += export_object_to_OBJ(obj, context, io_groups, shape_snapshots, base_gamepath, shape_refs)
+            if shape_snapshots:
+                shapetable_task = (shapetable_report(shape_snapshots), ShapeTable.instance().update_file, base_gamepath / "data" / "shapetable.dat", *shape_snapshots)
+                io_groups.append(("the selected shapes", [shapetable_task]))
             if len(original_selection)>0:
-                select(*original_selection)
+                restore_selection(context, original_selection, original_active)
             wm.progress_end()
+        if io_groups:
+            # the report is shown once the files are written
+            start_post_export_io(output_messages, io_groups)
+            return {'FINISHED'}
         bpy.context.window_manager.popup_menu(
             lambda self, ctx: ( [self.layout.label(text=x) for x in output_messages] ),
             title="Export Report", 
@@ -776,16 +1095,15 @@ class SCRIPTS_OT_uvii_start_game(bpy.types.Operator):
             return False
         if addon_prefs.game_path=="":
             return False
-        game_path = Path(addon_prefs.game_path)
-        if not game_path.exists():
+        if not _cached_exists(_game_path()):
             return False
-        if not (game_path / "U7Revisited.exe").exists():
+        if not _cached_exists(_game_exe(_game_path())):
             return False
         return True
 
     def execute(self, context):
         addon_prefs = context.preferences.addons["ultimavii_exporter"].preferences
-        game_exe = Path(addon_prefs.game_path) / "U7Revisited.exe"
+        game_exe = _game_exe(_game_path())
         subprocess.Popen(str(game_exe), cwd=addon_prefs.game_path, shell=True)
         return {'FINISHED'}
 
@@ -824,60 +1142,77 @@ class SCRIPTS_OT_pack_uvii_asset(bpy.types.Operator):
 
     def execute(self, context):
         """This is called after the window opened."""
+        wait_for_post_export_io()
         addon_prefs = context.preferences.addons["ultimavii_exporter"].preferences
-        base_gamepath = Path(addon_prefs.game_path)
+        base_gamepath = _game_path()
         print(f"Filepath: {self.filepath}")
         if "." not in self.filepath or self.filepath[-4]!=".zip":
             self.filepath = self.filepath.split(".")[0]+".zip"
         settings = context.active_object.uvii_export_settings
         settings.zip_path = self.filepath
-        if Path(self.filepath).exists():
-            Path(self.filepath).unlink()
-        with zipfile.ZipFile(self.filepath, mode="w") as archive:
+        try:
+            os.remove(self.filepath)
+        except FileNotFoundError:
+            pass
+        with zipfile.ZipFile(self.filepath, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
             # obj
-            export_files = []
+            export_files = set()
             export_shapes = []
 
-            selected_objects = []
-            if len(context.selected_objects)==0:
-                selected_objects.append(context.active_object)
-            else:
-                selected_objects = [o for o in context.selected_objects]
-            for obj in selected_objects:
-                if not obj.uvii_export_settings.is_uvii:
-                    continue
-                asset_path = full_export_filepath(obj)
+            def add_file(path):
+                if path in export_files:
+                    return
+                export_files.add(path)
+                if path.suffix.lower() not in _STORED_SUFFIXES:
+                    archive.write(path, arcname=path.name)
+                    return
+                zinfo = zipfile.ZipInfo.from_file(path, arcname=path.name)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                if zinfo.file_size < _ZIP_STREAM_THRESHOLD:
+                    archive.write(path, arcname=path.name, compress_type=zipfile.ZIP_STORED)
+                    return
+                with open(path, "rb") as src, archive.open(zinfo, "w", force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, _ZIP_COPY_BUFFER)
+
+            selected_objects = context.selected_objects or (context.active_object,)
+            shape_refs = shape_refs_by_parent(selected_objects)
+            entries = []
+            debug_output = addon_prefs.debug_output
+            for obj, obj_settings in _iter_uvii(selected_objects):
+                asset_path = full_export_filepath(obj, base_gamepath)
                 if asset_path not in export_files:
-                    export_files.append(asset_path)
-                    export_files.append(asset_path.with_suffix(".mtl"))
+                    add_file(asset_path)
+                    add_file(asset_path.with_suffix(".mtl"))
                 # texture
-                if len(obj.data.materials)>0:
-                    tex_path = get_color_tex_path(obj.data.materials[0])
-                    if tex_path not in export_files:
-                        export_files.append(tex_path)
+                materials = obj.data.materials
+                if len(materials)>0:
+                    tex_path = get_color_tex_path(materials[0])
+                    if tex_path is not None:
+                        add_file(tex_path)
                     # archive.write(tex_path, arcname=tex_path.name)
                 # shapetable.dat
-                entries = []
                 if addon_prefs.write_shapetable:
                     # collect entries
-                    obj.uvii_export_settings.zip_path = self.filepath
-                    entries.append(obj.uvii_export_settings)
-                    print(f"Main Settings: {obj.uvii_export_settings.shape_id}-{obj.uvii_export_settings.frame}")
-                    for o in obj.children:
-                        if o.uvii_export_settings.is_uvii and o.uvii_export_settings.is_shape_ref:
-                            print(f"Child Settings: {o.uvii_export_settings.shape_id}-{o.uvii_export_settings.frame}")
-                            entries.append(o.uvii_export_settings)
-                    shapetable = ShapeTable.instance()
-                    shapetable.load(base_gamepath / "data" / "shapetable.dat")
-                    shapetable.update_shapes(*entries)
-                    export_shapes += [shapetable.shapes[e.shape_id][e.frame] for e in entries]
-                    # lines = "".join([shapetable.shapes[e.shape_id][e.frame].to_line() for e in entries])
-                    # archive.writestr("shapetable.dat", lines)
-            for export_file in export_files:
-                archive.write(export_file, arcname=export_file.name)
-            export_shapes.sort(key=lambda l: float(l.id)+float(l.frame)*.001)
-            line_str = "".join([s.to_line() for s in export_shapes])
-            archive.writestr("shapetable.dat", line_str)
+                    obj_settings.zip_path = self.filepath
+                    entries.append(obj_settings)
+                    if debug_output:
+                        print(f"Main Settings: {obj_settings.shape_id}-{obj_settings.frame}")
+                    for child_settings in _shape_ref_settings(obj, shape_refs):
+                        if debug_output:
+                            print(f"Child Settings: {child_settings.shape_id}-{child_settings.frame}")
+                        entries.append(child_settings)
+            if entries:
+                shapetable = ShapeTable.instance()
+                shapetable.load(base_gamepath / "data" / "shapetable.dat")
+                shapetable.update_shapes(*entries)
+                entry = shapetable.entry
+                export_shapes.extend(entry(e.shape_id, e.frame) for e in entries)
+                # lines = "".join([shapetable.entry(e.shape_id, e.frame).to_line() for e in entries])
+                # archive.writestr("shapetable.dat", lines)
+            export_shapes.sort(key=operator.attrgetter("id", "frame"))
+            with archive.open("shapetable.dat", "w") as shapefile:
+                for s in export_shapes:
+                    shapefile.write(s.to_line().encode("utf-8"))
         return {'FINISHED'}
 # --------------------------------------------------------------------------------
 # User Interface
@@ -897,23 +1232,23 @@ class SCRIPTS_PT_uvii_user_interface(bpy.types.Panel):
         if addon_prefs.game_path=="":
             box.label(text="No game path set in prefs.")
             return
-        game_path = Path(addon_prefs.game_path)
-        if not game_path.exists():
+        game_path = _game_path()
+        if not _cached_exists(game_path):
             box.label(text="Game path doesn't exist.")
             return
-        if not (game_path / "U7Revisited.exe").exists():
+        if not _cached_exists(_game_exe(game_path)):
             box.label(text="Game exec doesn't exist at game path.")
             box.label(text="Are you sure the game path is correct?")
             return            
-        if context.active_object == None:
+        active_object = context.active_object
+        if active_object == None:
             box.label(text="Nothing selected.")
             box.separator(type="LINE")
             box.operator("scripts.uvii_start_game", icon="GHOST_ENABLED")
             return
-        if len(context.selected_objects)>1:
-            show_ui = False
-            for obj in context.selected_objects:
-                show_ui = show_ui or obj.uvii_export_settings.is_uvii
+        selected_objects = context.selected_objects
+        if len(selected_objects)>1:
+            show_ui = any(obj.uvii_export_settings.is_uvii for obj in selected_objects)
             if show_ui:
                 box.operator("scripts.uvii_export_asset", text="Export all selected Shapes")
                 box.separator(type="LINE")
@@ -922,13 +1257,13 @@ class SCRIPTS_PT_uvii_user_interface(bpy.types.Panel):
                 box.label(text="Not assets.")
             box.operator("scripts.uvii_start_game", icon="GHOST_ENABLED")
             return
-        settings = context.active_object.uvii_export_settings
-        if context.active_object.type!="MESH" and not settings.is_shape_ref:
+        settings = active_object.uvii_export_settings
+        if active_object.type!="MESH" and not settings.is_shape_ref:
             box.label(text="Not a mesh.")
             box.separator(type="LINE")
             box.operator("scripts.uvii_start_game", icon="GHOST_ENABLED")
             return
-        if not context.active_object.uvii_export_settings.is_uvii:
+        if not settings.is_uvii:
             box.label(text="Not an asset.")
             box.operator("scripts.uvii_create_shape")
             box.separator(type="LINE")
@@ -936,7 +1271,7 @@ class SCRIPTS_PT_uvii_user_interface(bpy.types.Panel):
             return
 
         if not settings.is_shape_ref:
-            box.label(text=f"Export Name:   \"{model_to_filename(context.active_object)}\"")
+            box.label(text=f"Export Name:   \"{model_to_filename(active_object)}\"")
         box.prop(settings, "add_shape_frame_suffix")
         box.prop(settings, "export_format")
         split = box.split()
@@ -958,7 +1293,7 @@ class SCRIPTS_PT_uvii_user_interface(bpy.types.Panel):
         split.operator("scripts.uvii_export_asset")
         split.operator("scripts.uvii_undo_shape", text="", icon="X")
         box.separator(type="LINE")
-        if context.active_object.type=="MESH":
+        if active_object.type=="MESH":
             split = box.split(factor=.9)
             split.operator("scripts.uvii_add_shape", icon="ADD")
             split.operator("scripts.reload_shapedata", text="", icon="LOOP_BACK")
@@ -990,15 +1325,23 @@ blender_classes=[
     SCRIPTS_PT_uvii_user_interface
 ]
 
+_register_classes, _unregister_classes = bpy.utils.register_classes_factory(blender_classes)
+
 def register():
-    for blender_class in blender_classes:
-        bpy.utils.register_class(blender_class)
+    _register_classes()
     bpy.types.Object.uvii_export_settings = bpy.props.PointerProperty(type = SCRIPTS_PG_uvii_object_settings)
+    bpy.app.handlers.depsgraph_update_post.append(clear_tex_path_cache)
 
 def unregister():
+    # let running file writes finish, the timer showing their report goes away with the add-on
+    wait_for_post_export_io()
+    if bpy.app.timers.is_registered(show_post_export_reports):
+        bpy.app.timers.unregister(show_post_export_reports)
+    if clear_tex_path_cache in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(clear_tex_path_cache)
+    _TEX_PATH_CACHE.clear()
     del bpy.types.Object.uvii_export_settings
-    for blender_class in reversed(blender_classes):
-        bpy.utils.unregister_class(blender_class)
+    _unregister_classes()
 
 if __name__ == "__main__":
     register()
\ No newline at end of file